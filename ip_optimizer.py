@@ -6,15 +6,183 @@ Cloudflare IP优选脚本 - 获取特定国家IP数量
 
 import asyncio
 import aiohttp
+import heapq
 import json
 import random
+import re
 import ipaddress
+import socket
 import time
+import traceback
 import argparse
+import os
 import sys
 from typing import List, Dict, Optional, Tuple
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from operator import attrgetter
 from pathlib import Path
+from types import MappingProxyType
+
+from aiohttp.abc import AbstractResolver
+
+try:
+    import aiodns  # noqa: F401  可选依赖，安装后使用异步DNS解析
+except ImportError:
+    aiodns = None
+
+try:
+    import uvloop  # 可选依赖，更快的事件循环
+except ImportError:
+    uvloop = None
+
+try:
+    from orjson import loads as _json_loads  # 可选依赖，解析JSON更快
+except ImportError:
+    from json import loads as _json_loads
+
+# 0-255 对应的两位十六进制字符串，用于构造nip子域名
+_HEX_OCTETS = tuple(f"{i:02x}" for i in range(256))
+
+# 内置的Cloudflare colo到国家代码的映射，作为在线数据不可用时的兜底
+_BUILTIN_COLO_COUNTRY = MappingProxyType({
+    # 美国 - 主要数据中心
+    'ATL': 'US', 'BOS': 'US', 'BUF': 'US', 'CHI': 'US', 'DEN': 'US',
+    'DFW': 'US', 'EWR': 'US', 'IAD': 'US', 'LAS': 'US', 'LAX': 'US',
+    'MIA': 'US', 'MSP': 'US', 'ORD': 'US', 'PDX': 'US', 'PHX': 'US',
+    'SAN': 'US', 'SEA': 'US', 'SJC': 'US', 'STL': 'US', 'IAH': 'US',
+    'JFK': 'US', 'LGA': 'US', 'BWI': 'US', 'DCA': 'US',
+
+    # 香港、台湾
+    'HKG': 'HK',  # 香港
+    'TPE': 'TW',  # 台湾
+
+    # 日本
+    'NRT': 'JP', 'KIX': 'JP', 'ITM': 'JP',
+
+    # 韩国
+    'ICN': 'KR', 'GMP': 'KR',
+
+    # 新加坡
+    'SIN': 'SG',
+
+    # 英国
+    'LHR': 'GB', 'MAN': 'GB', 'EDI': 'GB',
+
+    # 德国
+    'FRA': 'DE', 'DUS': 'DE', 'HAM': 'DE', 'MUC': 'DE',
+
+    # 法国
+    'CDG': 'FR', 'MRS': 'FR',
+
+    # 荷兰
+    'AMS': 'NL',
+
+    # 澳大利亚
+    'SYD': 'AU', 'MEL': 'AU', 'PER': 'AU', 'BNE': 'AU',
+
+    # 加拿大
+    'YYZ': 'CA', 'YVR': 'CA', 'YUL': 'CA', 'YYC': 'CA', 'YOW': 'CA',
+    'YWG': 'CA', 'YHZ': 'CA',
+
+    # 巴西
+    'GRU': 'BR', 'GIG': 'BR',
+
+    # 印度
+    'BOM': 'IN', 'DEL': 'IN', 'MAA': 'IN', 'BLR': 'IN',
+
+    # 其他欧洲国家
+    'ARN': 'SE',  # 瑞典
+    'CPH': 'DK',  # 丹麦
+    'OSL': 'NO',  # 挪威
+    'HEL': 'FI',  # 芬兰
+    'WAW': 'PL',  # 波兰
+    'PRG': 'CZ',  # 捷克
+    'VIE': 'AT',  # 奥地利
+    'ZUR': 'CH',  # 瑞士
+    'MAD': 'ES',  # 西班牙
+    'LIS': 'PT',  # 葡萄牙
+    'FCO': 'IT',  # 意大利
+    'ATH': 'GR',  # 希腊
+    'IST': 'TR',  # 土耳其
+    'SVO': 'RU',  # 俄罗斯
+    'VNO': 'LT',  # 立陶宛
+    'RIX': 'LV',  # 拉脱维亚
+    'TLL': 'EE',  # 爱沙尼亚
+})
+
+# 严格的点分十进制IPv4格式（每段0-255，不允许前导零）
+_IPV4_OCTET = r'(?:25[0-5]|2[0-4][0-9]|1[0-9][0-9]|[1-9]?[0-9])'
+_IPV4_RE = re.compile(rf'{_IPV4_OCTET}(?:\.{_IPV4_OCTET}){{3}}')
+
+# nip子域名的首段：IPv4地址四个字节的十六进制编码
+_NIP_LABEL_RE = re.compile(r'[0-9a-fA-F]{8}')
+
+# trace响应中需要的字段（ip、colo）
+_TRACE_FIELDS_RE = re.compile(r'[ \t]*(ip|colo)=[ \t]*(\S+)')
+
+# 本地缓存目录，用于跨运行复用DoH解析结果等数据
+_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'ipyxcm'
+
+# NIP域名缓存时间范围（秒），优先使用TXT记录自带的TTL
+_NIP_CACHE_MIN_TTL = 300
+_NIP_CACHE_MAX_TTL = 86400
+
+# 数据中心映射的缓存时间（秒）
+_COLO_CACHE_TTL = 7 * 86400
+
+# IP源列表的缓存时间（秒）
+_SOURCE_CACHE_TTL = 12 * 3600
+
+# 获取官方列表失败时使用的默认CIDR列表
+_DEFAULT_CF_CIDRS = (
+    "173.245.48.0/20",
+    "103.21.244.0/22",
+    "103.22.200.0/22",
+    "103.31.4.0/22",
+    "141.101.64.0/18",
+    "108.162.192.0/18",
+    "190.93.240.0/20",
+    "188.114.96.0/20",
+    "197.234.240.0/22",
+    "198.41.128.0/17",
+    "162.158.0.0/15",
+    "104.16.0.0/13",
+    "104.24.0.0/14",
+    "172.64.0.0/13",
+    "131.0.72.0/22",
+)
+
+def _read_cache(name: str) -> Optional[Dict]:
+    """读取未过期的缓存，不存在或已过期时返回None"""
+    try:
+        with open(_CACHE_DIR / name, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # 缓存文件损坏（结构或字段类型不对）时视为没有缓存
+    if not isinstance(data, dict):
+        return None
+    expires = data.get('expires')
+    if isinstance(expires, (int, float)) and not isinstance(expires, bool) and expires > time.time():
+        return data
+    return None
+
+def _write_cache(name: str, data: Dict, ttl: float) -> None:
+    """原子写入缓存（先写临时文件再重命名），失败时静默忽略"""
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        path = _CACHE_DIR / name
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(dict(data, expires=time.time() + ttl), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"⚠️ 写入缓存 {name} 失败: {e}")
+
+def _is_non_retryable(exc: Exception) -> bool:
+    """判断测试异常是否无需重试（目标IP端口连接被拒绝或被重置）"""
+    return (isinstance(exc, aiohttp.ClientConnectorError)
+            and isinstance(getattr(exc, 'os_error', None), (ConnectionRefusedError, ConnectionResetError)))
 
 @dataclass
 class IPResult:
@@ -25,73 +193,116 @@ class IPResult:
     colo: str
     country: str
     type: str  # 'official' or 'proxy'
-    
+    type_text: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        self.type_text = "官方优选" if self.type == "official" else "反代优选"
+
     def to_display_format(self) -> str:
         """转换为显示格式"""
-        type_text = "官方优选" if self.type == "official" else "反代优选"
-        return f"{self.ip}:{self.port}#{self.country} {type_text} {self.latency:.0f}ms"
+        return f"{self.ip}:{self.port}#{self.country} {self.type_text} {self.latency:.0f}ms"
 
-class CloudflareIPOptimizer:
-    """Cloudflare IP优选器"""
-    
-    def __init__(self, target_country: str = "CN", max_ips: int = 512, max_concurrent: int = 32, target_count: int = 10):
-        # 支持多个国家，用逗号分隔
-        if ',' in target_country:
-            self.target_countries = [c.strip().upper() for c in target_country.split(',')]
-        else:
-            self.target_countries = [target_country.upper()]
+@dataclass
+class _TestProgress:
+    """一轮并发测试的累计状态"""
+    total: int
+    target: int = 0  # 需要找到的目标国家IP数量
+    completed: int = 0
+    results: List[IPResult] = field(default_factory=list)
+    country_results: List[IPResult] = field(default_factory=list)
+    stop_event: asyncio.Event = field(default_factory=asyncio.Event)
+
+class NipResolver(AbstractResolver):
+    """nip子域名本地解析器：直接从子域名中解码出IP，其余域名交给后备解析器"""
+
+    def __init__(self, fallback: AbstractResolver):
+        self.domain: Optional[str] = None  # NIP域名，确定后由客户端设置
+        self._fallback = fallback
+
+    async def resolve(self, host: str, port: int = 0, family: socket.AddressFamily = socket.AF_INET) -> List[Dict]:
+        ip = self._decode_nip_host(host)
+        if ip and family in (socket.AF_UNSPEC, socket.AF_INET):
+            return [{
+                'hostname': host,
+                'host': ip,
+                'port': port,
+                'family': socket.AF_INET,
+                'proto': 0,
+                'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            }]
+        return await self._fallback.resolve(host, port, family)
+
+    async def close(self) -> None:
+        await self._fallback.close()
+
+    def _decode_nip_host(self, host: str) -> Optional[str]:
+        """将 {hex}.{nip_domain} 形式的域名解码为IP，不匹配时返回None"""
+        label, _, suffix = host.partition('.')
+        if not self.domain or suffix != self.domain or not _NIP_LABEL_RE.fullmatch(label):
+            return None
+        value = int(label, 16)
+        return f"{value >> 24}.{(value >> 16) & 0xFF}.{(value >> 8) & 0xFF}.{value & 0xFF}"
 
-        self.target_country = target_country.upper()  # 保持兼容性
-        self.max_ips = max_ips
-        self.max_concurrent = max_concurrent
-        self.target_count = target_count  # 目标IP数量
+class CloudflareClient:
+    """Cloudflare HTTP客户端，持有会话、NIP域名和colo映射，可在多个优选器之间共享"""
+
+    def __init__(self, max_concurrent: int = 32):
+        self.max_concurrent = max_concurrent  # 用于确定连接池大小
         self.nip_domain = "ip.090227.xyz"  # 默认域名
         self.session: Optional[aiohttp.ClientSession] = None
+        self._resolver: Optional[NipResolver] = None
+        self._colo_country: Dict[str, str] = {}  # colo -> 国家代码，在 __aenter__ 中加载
 
-        # 定义所有可用的IP源，按优先级排序
-        self.ip_sources = [
-            "official",    # CF官方列表（优先级最高）
-            "cm",          # CM整理列表
-            "as13335",     # AS13335 CF全段
-            "as209242",    # AS209242 CF非官方
-            "proxyip",     # 反代IP列表
-            "as24429",     # AS24429 Alibaba
-            "as35916",     # AS35916
-            "as199524",    # AS199524 G-Core
-        ]
-        
     async def __aenter__(self):
         """异步上下文管理器入口"""
         # 创建更宽松的连接器，适用于测试环境
+        # 每个测试IP都是独立的nip子域名，按主机限流没有意义，只限制总连接数
+        # aiodns 在 Windows 默认的 Proactor 事件循环下不可用，因此仅在其他平台启用
+        fallback = aiohttp.AsyncResolver() if aiodns and sys.platform != 'win32' else aiohttp.ThreadedResolver()
+        # 测试用的nip子域名本身就编码了目标IP，在本地解码即可，无需任何DNS查询
+        self._resolver = NipResolver(fallback)
         connector = aiohttp.TCPConnector(
             ssl=False,  # 在测试环境中禁用SSL验证
-            limit=100,
-            limit_per_host=50,
+            limit=max(self.max_concurrent * 2, 16),
+            limit_per_host=0,
             ttl_dns_cache=300,
-            use_dns_cache=True
+            use_dns_cache=True,
+            keepalive_timeout=30,  # 让DoH、IP列表等请求在整个运行期间复用连接
+            resolver=self._resolver
         )
 
         self.session = aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=10),
+            timeout=aiohttp.ClientTimeout(total=15, connect=5),
             connector=connector
         )
-        await self._get_nip_domain()
+        # NIP域名解析和数据中心列表互不依赖，并发获取
+        await asyncio.gather(self._get_nip_domain(), self._load_colo_table())
+        self._resolver.domain = self.nip_domain
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         """异步上下文管理器出口"""
         if self.session:
             await self.session.close()
+        # 自定义解析器不归连接器管理，需要单独关闭
+        if self._resolver:
+            await self._resolver.close()
     
     async def _get_nip_domain(self) -> None:
         """获取NIP域名"""
         # 在GitHub Actions等CI环境中，直接使用已知的可用域名
-        import os
         if os.environ.get('GITHUB_ACTIONS') == 'true':
             print("检测到GitHub Actions环境，使用预设域名")
             self.nip_domain = "nip.lfree.org"
             return
 
+        # 优先使用本地缓存，跳过DoH请求
+        cached = _read_cache('nip_domain.json')
+        if cached and isinstance(cached.get('domain'), str) and cached['domain']:
+            self.nip_domain = cached['domain']
+            print(f"✅ 使用缓存的域名: {self.nip_domain}")
+            return
+
         # 尝试多个DoH服务器
         doh_servers = [
             ("https://1.1.1.1/dns-query", "Cloudflare"),
@@ -110,11 +321,13 @@ class CloudflareIPOptimizer:
                 print(f"尝试通过 {provider} DoH 解析...")
                 async with self.session.get(doh_url, params=params, headers=headers, timeout=aiohttp.ClientTimeout(total=3)) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = _json_loads(await response.read())
                         if data.get('Status') == 0 and data.get('Answer'):
-                            txt_record = data['Answer'][0]['data']
-                            self.nip_domain = txt_record.strip('"')
+                            answer = data['Answer'][0]
+                            self.nip_domain = answer['data'].strip('"')
                             print(f"✅ 通过 {provider} DoH解析获取到域名: {self.nip_domain}")
+                            ttl = min(max(answer.get('TTL', 3600), _NIP_CACHE_MIN_TTL), _NIP_CACHE_MAX_TTL)
+                            _write_cache('nip_domain.json', {'domain': self.nip_domain}, ttl)
                             return
                     else:
                         print(f"❌ {provider} DoH 返回状态码: {response.status}")
@@ -128,6 +341,111 @@ class CloudflareIPOptimizer:
         self.nip_domain = backup_domains[0]
         print(f"📡 使用备用域名: {self.nip_domain}")
     
+    async def _load_colo_table(self) -> None:
+        """预先加载colo到国家代码的映射表"""
+        colo_to_country = dict(_BUILTIN_COLO_COUNTRY)
+
+        # 数据中心列表很少变化，优先使用本地缓存
+        cached = _read_cache('colo_country.json')
+        colos = cached.get('colos') if cached else None
+        # 缓存内容可能被损坏，键值类型不对时视为未命中
+        if (isinstance(colos, dict) and colos
+                and all(isinstance(k, str) and isinstance(v, str) for k, v in colos.items())):
+            colo_to_country.update(colos)
+            self._colo_country = colo_to_country
+            print(f"✅ 使用缓存的数据中心映射，共 {len(colo_to_country)} 个")
+            return
+
+        # 使用Cloudflare官方数据中心列表补全映射，整个运行期间只请求一次
+        try:
+            async with self.session.get("https://speed.cloudflare.com/locations",
+                                        timeout=aiohttp.ClientTimeout(total=3)) as response:
+                if response.status == 200:
+                    locations = _json_loads(await response.read())
+                    online_colos = {loc['iata'].upper(): loc['cca2'].upper() for loc in locations
+                                    if loc.get('iata') and loc.get('cca2')}
+                    colo_to_country.update(online_colos)
+                    print(f"✅ 已加载 {len(colo_to_country)} 个数据中心的国家映射")
+                    if online_colos:
+                        _write_cache('colo_country.json', {'colos': online_colos}, _COLO_CACHE_TTL)
+                else:
+                    print(f"⚠️ 获取数据中心列表失败，状态码: {response.status}，使用内置映射")
+        except Exception as e:
+            print(f"⚠️ 获取数据中心列表失败: {str(e)[:50]}，使用内置映射")
+
+        self._colo_country = colo_to_country
+
+    def get_country_from_colo(self, colo: str) -> str:
+        """从colo获取国家代码"""
+        colo_upper = colo.upper()
+        country = self._colo_country.get(colo_upper)
+        if country:
+            return country
+        # 加拿大机场代码多以Y开头
+        if len(colo_upper) == 3 and colo_upper.startswith('Y'):
+            return 'CA'
+        # 映射表中没有时，返回原始colo代码作为国家代码
+        return colo_upper
+
+class CloudflareIPOptimizer:
+    """Cloudflare IP优选器"""
+    
+    def __init__(self, target_country: str = "CN", max_ips: int = 512, max_concurrent: int = 32, target_count: int = 10,
+                 client: Optional[CloudflareClient] = None):
+        # 支持多个国家，用逗号分隔
+        if ',' in target_country:
+            self.target_countries = [c.strip().upper() for c in target_country.split(',')]
+        else:
+            self.target_countries = [target_country.upper()]
+
+        self.target_country = target_country.upper()  # 保持兼容性
+        self.max_ips = max_ips
+        self.max_concurrent = max_concurrent
+        self.target_count = target_count  # 目标IP数量
+        # 共享的HTTP客户端，多个国家/多次运行可复用同一个会话
+        self.client = client
+        self._owns_client = False
+        # 单个IP测试的超时配置，所有测试共用同一个实例
+        self._test_timeout = aiohttp.ClientTimeout(total=5.0, connect=2.5)
+
+        # 定义所有可用的IP源，按优先级排序
+        self.ip_sources = [
+            "official",    # CF官方列表（优先级最高）
+            "cm",          # CM整理列表
+            "as13335",     # AS13335 CF全段
+            "as209242",    # AS209242 CF非官方
+            "proxyip",     # 反代IP列表
+            "as24429",     # AS24429 Alibaba
+            "as35916",     # AS35916
+            "as199524",    # AS199524 G-Core
+        ]
+
+    @property
+    def session(self) -> Optional[aiohttp.ClientSession]:
+        """共享客户端的HTTP会话"""
+        return self.client.session if self.client else None
+
+    @property
+    def nip_domain(self) -> str:
+        """共享客户端解析到的NIP域名"""
+        return self.client.nip_domain
+
+    async def __aenter__(self):
+        """异步上下文管理器入口"""
+        # 未传入共享客户端时，自行创建并负责关闭
+        if self.client is None:
+            self.client = CloudflareClient(max_concurrent=self.max_concurrent)
+            self._owns_client = True
+            await self.client.__aenter__()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """异步上下文管理器出口"""
+        if self._owns_client and self.client:
+            await self.client.__aexit__(exc_type, exc_val, exc_tb)
+            self.client = None
+            self._owns_client = False
+
     async def get_cf_ips(self, ip_source: str = "official", target_port: str = "443") -> List[str]:
         """获取Cloudflare IP列表"""
         print(f"正在获取 {ip_source} IP列表...")
@@ -150,28 +468,11 @@ class CloudflareIPOptimizer:
             else:  # official
                 url = "https://www.cloudflare.com/ips-v4/"
             
-            async with self.session.get(url) as response:
-                if response.status == 200:
-                    text = await response.text()
-                else:
-                    # 使用默认CIDR列表
-                    text = """173.245.48.0/20
-103.21.244.0/22
-103.22.200.0/22
-103.31.4.0/22
-141.101.64.0/18
-108.162.192.0/18
-190.93.240.0/20
-188.114.96.0/20
-197.234.240.0/22
-198.41.128.0/17
-162.158.0.0/15
-104.16.0.0/13
-104.24.0.0/14
-172.64.0.0/13
-131.0.72.0/22"""
-            
-            cidrs = [line.strip() for line in text.split('\n') if line.strip() and not line.startswith('#')]
+            cidrs = await self._fetch_list_lines(ip_source, url)
+            if cidrs is None:
+                # 使用默认CIDR列表
+                cidrs = list(_DEFAULT_CF_CIDRS)
+
             return self._generate_ips_from_cidrs(cidrs)
             
         except Exception as e:
@@ -182,33 +483,59 @@ class CloudflareIPOptimizer:
         """获取反代IP列表"""
         try:
             url = "https://raw.githubusercontent.com/cmliu/ACL4SSR/main/baipiao.txt"
-            async with self.session.get(url) as response:
-                if response.status != 200:
-                    return []
-                
-                text = await response.text()
-                lines = [line.strip() for line in text.split('\n') 
-                        if line.strip() and not line.startswith('#')]
-                
-                valid_ips = []
-                for line in lines:
-                    parsed_ip = self._parse_proxy_ip_line(line, target_port)
-                    if parsed_ip:
-                        valid_ips.append(parsed_ip)
-                
-                print(f"反代IP列表解析完成，端口{target_port}匹配到{len(valid_ips)}个有效IP")
-                
-                # 如果超过512个IP，随机选择512个
-                if len(valid_ips) > self.max_ips:
-                    valid_ips = random.sample(valid_ips, self.max_ips)
-                    print(f"IP数量超过{self.max_ips}个，随机选择了{len(valid_ips)}个IP")
-                
-                return valid_ips
-                
+            lines = await self._fetch_list_lines("proxyip", url)
+            if lines is None:
+                return []
+
+            valid_ips = []
+            for line in lines:
+                parsed_ip = self._parse_proxy_ip_line(line, target_port)
+                if parsed_ip:
+                    valid_ips.append(parsed_ip)
+
+            print(f"反代IP列表解析完成，端口{target_port}匹配到{len(valid_ips)}个有效IP")
+
+            # 如果超过512个IP，随机选择512个
+            if len(valid_ips) > self.max_ips:
+                valid_ips = random.sample(valid_ips, self.max_ips)
+                print(f"IP数量超过{self.max_ips}个，随机选择了{len(valid_ips)}个IP")
+
+            return valid_ips
+
         except Exception as e:
             print(f"获取反代IP失败: {e}")
             return []
     
+    async def _fetch_list_lines(self, ip_source: str, url: str) -> Optional[List[str]]:
+        """获取IP源的列表内容，优先使用本地缓存，响应状态码异常时返回None"""
+        cache_name = f"source_{ip_source}.json"
+        cached = _read_cache(cache_name)
+        lines = cached.get('lines') if cached and cached.get('url') == url else None
+        # 缓存内容可能被损坏，元素类型不对时视为未命中
+        if isinstance(lines, list) and lines and all(isinstance(line, str) for line in lines):
+            print(f"使用缓存的 {ip_source} 列表，共{len(lines)}行")
+            return lines
+
+        async with self.session.get(url) as response:
+            if response.status != 200:
+                return None
+            lines = await self._read_list_lines(response)
+
+        # 缓存原始列表而不是生成的IP，每次运行仍会重新随机抽样
+        if lines:
+            _write_cache(cache_name, {'url': url, 'lines': lines}, _SOURCE_CACHE_TTL)
+        return lines
+
+    async def _read_list_lines(self, response: aiohttp.ClientResponse) -> List[str]:
+        """逐行读取列表响应，跳过空行和注释行"""
+        lines = []
+        async for raw_line in response.content:
+            # 在字节层面过滤空行和注释行，只解码需要保留的行
+            line = raw_line.strip()
+            if line and not line.startswith(b'#'):
+                lines.append(line.decode('utf-8', errors='ignore'))
+        return lines
+
     def _parse_proxy_ip_line(self, line: str, target_port: str) -> Optional[str]:
         """解析反代IP行"""
         try:
@@ -267,83 +594,80 @@ class CloudflareIPOptimizer:
     
     def _is_valid_ip(self, ip: str) -> bool:
         """验证IP地址格式"""
-        try:
-            ipaddress.IPv4Address(ip)
-            return True
-        except ipaddress.AddressValueError:
-            return False
+        return _IPV4_RE.fullmatch(ip) is not None
     
     def _generate_ips_from_cidrs(self, cidrs: List[str]) -> List[str]:
         """从CIDR列表生成IP"""
-        ips = set()
         target_count = self.max_ips
-        round_num = 1
-        
-        while len(ips) < target_count and round_num <= 100:
-            print(f"第{round_num}轮生成IP，当前已有{len(ips)}个")
-            
-            for cidr in cidrs:
-                if len(ips) >= target_count:
-                    break
-                
-                cidr_ips = self._generate_ips_from_cidr(cidr.strip(), round_num)
-                ips.update(cidr_ips)
-                
-                print(f"CIDR {cidr} 第{round_num}轮生成{len(cidr_ips)}个IP，总计{len(ips)}个")
-            
-            round_num += 1
-        
-        print(f"最终生成{len(ips)}个不重复IP")
-        return list(ips)[:target_count]
-    
-    def _generate_ips_from_cidr(self, cidr: str, count: int = 1) -> List[str]:
-        """从单个CIDR生成IP"""
-        try:
-            network = ipaddress.IPv4Network(cidr, strict=False)
+
+        # 每个CIDR只解析一次，得到 (起始地址整数, 可用主机数)
+        networks = []
+        for cidr in cidrs:
+            try:
+                network = ipaddress.IPv4Network(cidr.strip(), strict=False)
+            except ValueError as e:
+                print(f"解析CIDR {cidr} 失败: {e}")
+                continue
             max_hosts = network.num_addresses - 2  # 排除网络地址和广播地址
-            
-            if max_hosts <= 0:
-                return []
-            
-            actual_count = min(count, max_hosts)
-            ips = set()
-            
-            attempts = 0
-            max_attempts = actual_count * 10
-            
-            while len(ips) < actual_count and attempts < max_attempts:
-                # 生成随机偏移量，避免网络地址
-                random_offset = random.randint(1, max_hosts)
-                random_ip = str(network.network_address + random_offset)
-                ips.add(random_ip)
-                attempts += 1
-            
-            return list(ips)
+            if max_hosts > 0:
+                networks.append((int(network.network_address), max_hosts))
 
-        except Exception as e:
-            print(f"生成CIDR {cidr} IP失败: {e}")
+        if not networks:
+            print("没有可用的CIDR，生成0个IP")
             return []
 
+        # 按CIDR平均分配名额，小网段分不满的名额让给其他网段
+        quotas = [0] * len(networks)
+        remaining = target_count
+        while remaining > 0:
+            open_indexes = [i for i, (_, hosts) in enumerate(networks) if quotas[i] < hosts]
+            if not open_indexes:
+                break
+            share = max(1, remaining // len(open_indexes))
+            for i in open_indexes:
+                add = min(share, networks[i][1] - quotas[i], remaining)
+                quotas[i] += add
+                remaining -= add
+                if remaining == 0:
+                    break
+
+        # 每个CIDR一次性抽取不重复的主机偏移量，避免逐个IP重试去重
+        ips = set()
+        for (base, max_hosts), quota in zip(networks, quotas):
+            if quota == 0:
+                continue
+            for offset in random.sample(range(1, max_hosts + 1), quota):
+                value = base + offset
+                ips.add(f"{value >> 24}.{(value >> 16) & 0xFF}.{(value >> 8) & 0xFF}.{value & 0xFF}")
+
+        result = list(ips)
+        random.shuffle(result)  # 打乱顺序，避免提前停止时只测试靠前的网段
+        print(f"从 {len(networks)} 个CIDR最终生成{len(result)}个不重复IP")
+        return result[:target_count]
+
     async def test_ip(self, ip: str, port: int) -> Optional[IPResult]:
         """测试单个IP"""
-        timeout = 5.0
-
         # 解析IP格式
         parsed_ip = self._parse_ip_format(ip, port)
         if not parsed_ip:
             return None
 
+        # 测试URL只构建一次，重试时复用
+        test_url = self._build_test_url(parsed_ip['host'], parsed_ip['port'])
+
         # 进行测试，最多重试3次
         for attempt in range(1, 4):
-            result = await self._single_test(parsed_ip['host'], parsed_ip['port'], timeout)
+            try:
+                result = await self._single_test(parsed_ip['host'], parsed_ip['port'], test_url)
+            except aiohttp.ClientError as e:
+                print(f"IP {parsed_ip['host']}:{parsed_ip['port']} 第{attempt}次测试失败，无需重试: {e.__class__.__name__}")
+                return None
+
             if result:
                 print(f"IP {parsed_ip['host']}:{parsed_ip['port']} 第{attempt}次测试成功: {result['latency']:.0f}ms, colo: {result['colo']}")
 
                 # 获取国家代码
-                country_code = await self._get_country_from_colo(result['colo'])
-
-                # 生成显示格式
-                type_text = "官方优选" if result['type'] == "official" else "反代优选"
+                country_code = self.client.get_country_from_colo(result['colo'])
 
                 return IPResult(
                     ip=parsed_ip['host'],
@@ -353,15 +677,20 @@ class CloudflareIPOptimizer:
                     country=country_code,
                     type=result['type']
                 )
-            else:
-                print(f"IP {parsed_ip['host']}:{parsed_ip['port']} 第{attempt}次测试失败")
-                if attempt < 3:
-                    await asyncio.sleep(0.2)  # 短暂延迟后重试
+            elif attempt < 3:
+                # 带随机抖动的退避，避免大量IP同时重试
+                await asyncio.sleep(0.05 + random.random() * 0.3 * attempt)
 
+        # 每个IP只输出一行失败日志，而不是每次重试各一行
+        print(f"IP {parsed_ip['host']}:{parsed_ip['port']} 3次测试均失败")
         return None
 
     def _parse_ip_format(self, ip_string: str, default_port: int) -> Optional[Dict]:
         """解析IP格式"""
+        # 快速路径：CIDR生成的IP都是不带端口和注释的 a.b.c.d 形式
+        if _IPV4_RE.fullmatch(ip_string):
+            return {'host': ip_string, 'port': default_port, 'comment': None}
+
         try:
             host = ""
             port = default_port
@@ -397,28 +726,30 @@ class CloudflareIPOptimizer:
         except Exception:
             return None
 
-    async def _single_test(self, ip: str, port: int, timeout: float) -> Optional[Dict]:
+    def _build_test_url(self, ip: str, port: int) -> str:
+        """构建IP对应的nip测试URL"""
+        a, b, c, d = ip.split('.')
+        nip = _HEX_OCTETS[int(a)] + _HEX_OCTETS[int(b)] + _HEX_OCTETS[int(c)] + _HEX_OCTETS[int(d)]
+        return f"https://{nip}.{self.nip_domain}:{port}/cdn-cgi/trace"
+
+    async def _single_test(self, ip: str, port: int, test_url: str) -> Optional[Dict]:
         """单次IP测试"""
         try:
-            # 构建测试URL
-            parts = ip.split('.')
-            hex_parts = [f"{int(part):02x}" for part in parts]
-            nip = ''.join(hex_parts)
-            test_url = f"https://{nip}.{self.nip_domain}:{port}/cdn-cgi/trace"
-
-            start_time = time.time()
+            # 使用事件循环的单调时钟计时，不受系统时间调整影响
+            loop = asyncio.get_running_loop()
+            start_time = loop.time()
 
             async with self.session.get(
                 test_url,
-                timeout=aiohttp.ClientTimeout(total=timeout, connect=timeout/2),
+                timeout=self._test_timeout,
                 allow_redirects=False
             ) as response:
                 if response.status == 200:
-                    latency = (time.time() - start_time) * 1000  # 转换为毫秒
-                    response_text = await response.text()
+                    # 收到响应头即记录延迟（首字节时间），不包含读取响应体的时间
+                    latency = (loop.time() - start_time) * 1000  # 转换为毫秒
 
-                    # 解析trace响应
-                    trace_data = self._parse_trace_response(response_text)
+                    # 流式解析trace响应，拿到所需字段后不再读取剩余内容
+                    trace_data = await self._read_trace_fields(response)
 
                     if trace_data and trace_data.get('ip') and trace_data.get('colo'):
                         # 判断IP类型
@@ -443,199 +774,117 @@ class CloudflareIPOptimizer:
         except asyncio.TimeoutError:
             return None
         except Exception as e:
+            # 不可重试的错误交给调用方处理，其余错误视为本次测试失败
+            if _is_non_retryable(e):
+                raise
             return None
 
-    def _parse_trace_response(self, response_text: str) -> Optional[Dict]:
-        """解析trace响应"""
-        try:
-            lines = response_text.split('\n')
-            data = {}
-
-            for line in lines:
-                trimmed_line = line.strip()
-                if trimmed_line and '=' in trimmed_line:
-                    key, value = trimmed_line.split('=', 1)
-                    data[key] = value
-
-            return data
-        except Exception:
-            return None
-
-    async def _get_country_from_colo(self, colo: str) -> str:
-        """从colo获取国家代码"""
-        # 扩展的Cloudflare colo到国家代码的映射
-        colo_to_country = {
-            # 美国 - 主要数据中心
-            'ATL': 'US', 'BOS': 'US', 'BUF': 'US', 'CHI': 'US', 'DEN': 'US',
-            'DFW': 'US', 'EWR': 'US', 'IAD': 'US', 'LAS': 'US', 'LAX': 'US',
-            'MIA': 'US', 'MSP': 'US', 'ORD': 'US', 'PDX': 'US', 'PHX': 'US',
-            'SAN': 'US', 'SEA': 'US', 'SJC': 'US', 'STL': 'US', 'IAH': 'US',
-
-            # 中国大陆和地区
-            'HKG': 'HK',  # 香港
-            'TPE': 'TW',  # 台湾
-
-            # 日本
-            'NRT': 'JP', 'KIX': 'JP', 'ITM': 'JP',
-
-            # 韩国
-            'ICN': 'KR', 'GMP': 'KR',
-
-            # 新加坡
-            'SIN': 'SG',
-
-            # 英国
-            'LHR': 'GB', 'MAN': 'GB', 'EDI': 'GB',
-
-            # 德国
-            'FRA': 'DE', 'DUS': 'DE', 'HAM': 'DE', 'MUC': 'DE',
-
-            # 法国
-            'CDG': 'FR', 'MRS': 'FR',
-
-            # 荷兰
-            'AMS': 'NL',
-
-            # 澳大利亚
-            'SYD': 'AU', 'MEL': 'AU', 'PER': 'AU', 'BNE': 'AU',
-
-            # 加拿大
-            'YYZ': 'CA', 'YVR': 'CA', 'YUL': 'CA',
-
-            # 巴西
-            'GRU': 'BR', 'GIG': 'BR',
-
-            # 印度
-            'BOM': 'IN', 'DEL': 'IN', 'MAA': 'IN', 'BLR': 'IN',
-
-            # 其他欧洲国家
-            'ARN': 'SE',  # 瑞典
-            'CPH': 'DK',  # 丹麦
-            'OSL': 'NO',  # 挪威
-            'HEL': 'FI',  # 芬兰
-            'WAW': 'PL',  # 波兰
-            'PRG': 'CZ',  # 捷克
-            'VIE': 'AT',  # 奥地利
-            'ZUR': 'CH',  # 瑞士
-            'MAD': 'ES',  # 西班牙
-            'LIS': 'PT',  # 葡萄牙
-            'FCO': 'IT',  # 意大利
-            'ATH': 'GR',  # 希腊
-            'IST': 'TR',  # 土耳其
-            'SVO': 'RU',  # 俄罗斯
-            'VNO': 'LT',  # 立陶宛
-            'RIX': 'LV',  # 拉脱维亚
-            'TLL': 'EE',  # 爱沙尼亚
-        }
-
-        # 尝试从映射表获取国家代码
-        country = colo_to_country.get(colo.upper())
-        if country:
-            return country
-
-        # 如果映射表中没有，尝试通过简单的规则推断
-        colo_upper = colo.upper()
-
-        # 一些常见的推断规则
-        if len(colo_upper) == 3:
-            # 大多数3字母代码是机场代码，可以做一些基本推断
-            if colo_upper.startswith('Y'):  # 加拿大机场代码通常以Y开头
-                return 'CA'
-            elif colo_upper in ['JFK', 'LGA', 'BWI', 'DCA']:  # 美国主要机场
-                return 'US'
-
-        # 如果都失败了，返回原始colo代码作为国家代码
-        return colo_upper
+    async def _read_trace_fields(self, response: aiohttp.ClientResponse) -> Dict:
+        """逐行读取trace响应，只提取需要的ip和colo字段"""
+        data = {}
+        async for raw_line in response.content:
+            match = _TRACE_FIELDS_RE.match(raw_line.decode('utf-8', errors='ignore'))
+            if match:
+                data[match.group(1)] = match.group(2)
+                if len(data) == 2:
+                    break
+        return data
 
     async def test_ips_with_concurrency(self, ips: List[str], port: int) -> List[IPResult]:
         """并发测试IP列表"""
-        results = []
-        total_ips = len(ips)
-        completed_tests = 0
-
-        print(f"开始测试 {total_ips} 个IP，端口 {port}，并发数 {self.max_concurrent}")
-
-        # 创建信号量限制并发数
-        semaphore = asyncio.Semaphore(self.max_concurrent)
+        progress = _TestProgress(total=len(ips))
 
-        async def test_with_semaphore(ip):
-            nonlocal completed_tests
-            async with semaphore:
-                result = await self.test_ip(ip, port)
-                completed_tests += 1
+        print(f"开始测试 {progress.total} 个IP，端口 {port}，并发数 {self.max_concurrent}")
 
-                if completed_tests % 50 == 0 or completed_tests == total_ips:
-                    progress = (completed_tests / total_ips) * 100
-                    print(f"测试进度: {completed_tests}/{total_ips} ({progress:.1f}%) - 有效IP: {len(results)}")
+        ip_iter = iter(ips)
+        await self._run_workers(lambda: self._concurrency_worker(ip_iter, port, progress), progress)
 
-                if result:
-                    results.append(result)
+        return progress.results
 
-                return result
+    async def test_ips_with_early_stop(self, ips: List[str], port: int,
+                                       target_count: Optional[int] = None) -> List[IPResult]:
+        """并发测试IP列表，找到 target_count（默认为 self.target_count）个目标国家IP时提前停止"""
+        target = self.target_count if target_count is None else target_count
+        progress = _TestProgress(total=len(ips), target=target)
 
-        # 创建所有任务
-        tasks = [test_with_semaphore(ip) for ip in ips]
+        print(f"  🧪 开始测试 {progress.total} 个IP，端口 {port}")
 
-        # 等待所有任务完成
-        await asyncio.gather(*tasks, return_exceptions=True)
+        ip_iter = iter(ips)
+        await self._run_workers(lambda: self._early_stop_worker(ip_iter, port, progress), progress)
 
-        return results
+        return progress.results
 
-    async def test_ips_with_early_stop(self, ips: List[str], port: int) -> List[IPResult]:
-        """并发测试IP列表，找到足够的目标国家IP时提前停止"""
-        results = []
-        country_results = []
-        total_ips = len(ips)
-        completed_tests = 0
+    async def _run_workers(self, worker_factory, progress: _TestProgress) -> None:
+        """启动固定数量的worker从同一个IP迭代器中取任务，全部完成或收到停止信号后返回"""
+        # IP数量少于并发数时（如CI中 --max-ips 较小），不创建多余的空闲worker
+        worker_count = min(self.max_concurrent, progress.total)
+        workers = [asyncio.create_task(worker_factory()) for _ in range(worker_count)]
+        all_done = asyncio.gather(*workers, return_exceptions=True)
+        stop_waiter = asyncio.create_task(progress.stop_event.wait())
 
-        print(f"  🧪 开始测试 {total_ips} 个IP，端口 {port}")
+        # 等待所有IP测试完成，或者找到足够的目标国家IP
+        await asyncio.wait({all_done, stop_waiter}, return_when=asyncio.FIRST_COMPLETED)
 
-        # 创建信号量限制并发数
-        semaphore = asyncio.Semaphore(self.max_concurrent)
-        stop_event = asyncio.Event()
+        # 取消仍在进行中的测试，不再等待它们超时
+        stop_waiter.cancel()
+        for task in workers:
+            task.cancel()
 
-        async def test_with_semaphore(ip):
-            nonlocal completed_tests, country_results
+        # worker本身不应抛出异常；万一出现，输出出来而不是静默丢弃
+        for outcome in await all_done:
+            if isinstance(outcome, Exception):
+                print(f"⚠️ 测试worker异常退出: {outcome!r}")
 
-            # 如果已经找到足够的目标国家IP，跳过测试
-            if stop_event.is_set():
-                return None
-
-            async with semaphore:
-                if stop_event.is_set():
-                    return None
+    async def _test_ip_safely(self, ip: str, port: int) -> Optional[IPResult]:
+        """测试单个IP，意外异常只影响当前IP，不会终止worker"""
+        try:
+            return await self.test_ip(ip, port)
+        except Exception as e:
+            print(f"IP {ip} 测试出现异常: {e!r}")
+            return None
 
-                result = await self.test_ip(ip, port)
-                completed_tests += 1
+    async def _concurrency_worker(self, ip_iter, port: int, progress: _TestProgress) -> None:
+        """依次领取并测试IP，直到IP用完"""
+        for ip in ip_iter:
+            result = await self._test_ip_safely(ip, port)
+            progress.completed += 1
 
-                if result:
-                    results.append(result)
+            if result:
+                progress.results.append(result)
 
-                    # 检查是否是目标国家的IP（支持多个国家）
-                    if result.country in self.target_countries:
-                        country_results.append(result)
+            if progress.completed % 50 == 0 or progress.completed == progress.total:
+                percent = (progress.completed / progress.total) * 100
+                print(f"测试进度: {progress.completed}/{progress.total} ({percent:.1f}%) - 有效IP: {len(progress.results)}")
 
-                        # 如果找到足够的目标国家IP，设置停止信号
-                        if len(country_results) >= self.target_count:
-                            countries_str = ', '.join(self.target_countries)
-                            print(f"  🎯 已找到 {len(country_results)} 个目标国家IP ({countries_str})，停止当前库的测试")
-                            stop_event.set()
+    async def _early_stop_worker(self, ip_iter, port: int, progress: _TestProgress) -> None:
+        """依次领取并测试IP，直到IP用完或收到停止信号"""
+        for ip in ip_iter:
+            # 如果已经找到足够的目标国家IP，不再领取新的IP
+            if progress.stop_event.is_set():
+                return
 
-                # 定期报告进度
-                if completed_tests % 20 == 0 or completed_tests == total_ips:
-                    progress = (completed_tests / total_ips) * 100
-                    countries_str = ', '.join(self.target_countries)
-                    print(f"  📊 进度: {completed_tests}/{total_ips} ({progress:.1f}%) - 目标国家IP ({countries_str}): {len(country_results)}")
+            result = await self._test_ip_safely(ip, port)
+            progress.completed += 1
 
-                return result
+            if result:
+                progress.results.append(result)
 
-        # 创建所有任务
-        tasks = [test_with_semaphore(ip) for ip in ips]
+                # 检查是否是目标国家的IP（支持多个国家）
+                if result.country in self.target_countries:
+                    progress.country_results.append(result)
 
-        # 等待所有任务完成或停止信号
-        await asyncio.gather(*tasks, return_exceptions=True)
+                    # 如果找到足够的目标国家IP，设置停止信号
+                    if len(progress.country_results) >= progress.target:
+                        countries_str = ', '.join(self.target_countries)
+                        print(f"  🎯 已找到 {len(progress.country_results)} 个目标国家IP ({countries_str})，停止当前库的测试")
+                        progress.stop_event.set()
+                        return
 
-        return results
+            # 定期报告进度
+            if progress.completed % 20 == 0 or progress.completed == progress.total:
+                percent = (progress.completed / progress.total) * 100
+                countries_str = ', '.join(self.target_countries)
+                print(f"  📊 进度: {progress.completed}/{progress.total} ({percent:.1f}%) - 目标国家IP ({countries_str}): {len(progress.country_results)}")
 
     async def get_country_ips_from_all_sources(self, target_port: str = "443") -> List[IPResult]:
         """遍历所有IP库获取指定国家的IP，直到找到目标数量"""
@@ -646,41 +895,54 @@ class CloudflareIPOptimizer:
         print("-" * 60)
 
         all_results = []
+        seen_ip_ports = set()  # 已收录的 (ip, port)，跨IP库去重
 
-        for i, source in enumerate(self.ip_sources, 1):
-            if len(all_results) >= self.target_count:
-                print(f"✅ 已找到足够的IP ({len(all_results)} 个)，停止搜索")
-                break
+        # 预取第一个源的IP列表
+        next_fetch = self._prefetch_source(0, target_port)
 
-            print(f"\n📚 [{i}/{len(self.ip_sources)}] 正在尝试 {source} IP库...")
+        try:
+            for i, source in enumerate(self.ip_sources, 1):
+                if len(all_results) >= self.target_count:
+                    print(f"✅ 已找到足够的IP ({len(all_results)} 个)，停止搜索")
+                    break
 
-            try:
-                # 获取当前源的结果
-                source_results = await self.get_country_ips_from_source(source, target_port)
-
-                if source_results:
-                    # 添加到总结果中，避免重复
-                    existing_ips = {f"{r.ip}:{r.port}" for r in all_results}
-                    new_results = [r for r in source_results if f"{r.ip}:{r.port}" not in existing_ips]
-
-                    all_results.extend(new_results)
-                    print(f"✅ 从 {source} 获得 {len(new_results)} 个新的 {self.target_country} IP")
-                    print(f"📊 当前总计: {len(all_results)} 个IP")
-
-                    # 如果已经找到足够的IP，可以提前结束
-                    if len(all_results) >= self.target_count:
-                        print(f"🎉 已达到目标数量 ({self.target_count} 个)！")
-                        break
-                else:
-                    print(f"❌ {source} 库未找到任何 {self.target_country} IP")
+                print(f"\n📚 [{i}/{len(self.ip_sources)}] 正在尝试 {source} IP库...")
 
-            except Exception as e:
-                print(f"❌ {source} 库处理失败: {e}")
-                continue
+                try:
+                    # 等待当前源的IP列表，同时在后台预取下一个源，让下载与测试重叠
+                    ips = await next_fetch
+                    next_fetch = self._prefetch_source(i, target_port)
+
+                    # 获取当前源的结果，只需补足还差的数量
+                    needed = self.target_count - len(all_results)
+                    source_results = await self.get_country_ips_from_source(source, target_port, ips, needed)
+
+                    if source_results:
+                        # 添加到总结果中，避免重复
+                        new_results = [r for r in source_results if (r.ip, r.port) not in seen_ip_ports]
+                        seen_ip_ports.update((r.ip, r.port) for r in new_results)
+
+                        all_results.extend(new_results)
+                        print(f"✅ 从 {source} 获得 {len(new_results)} 个新的 {self.target_country} IP")
+                        print(f"📊 当前总计: {len(all_results)} 个IP")
+
+                        # 如果已经找到足够的IP，可以提前结束
+                        if len(all_results) >= self.target_count:
+                            print(f"🎉 已达到目标数量 ({self.target_count} 个)！")
+                            break
+                    else:
+                        print(f"❌ {source} 库未找到任何 {self.target_country} IP")
+
+                except Exception as e:
+                    print(f"❌ {source} 库处理失败: {e}")
+                    continue
+        finally:
+            # 提前结束时取消尚未用到的预取任务
+            if next_fetch is not None:
+                next_fetch.cancel()
 
-        # 按延迟排序并限制数量
-        all_results.sort(key=lambda x: x.latency)
-        final_results = all_results[:self.target_count]
+        # 取延迟最低的前 target_count 个（结果按延迟升序）
+        final_results = heapq.nsmallest(self.target_count, all_results, key=attrgetter('latency'))
 
         print(f"\n" + "=" * 60)
         print(f"🏁 搜索完成！")
@@ -694,18 +956,27 @@ class CloudflareIPOptimizer:
 
         return final_results
 
-    async def get_country_ips_from_source(self, ip_source: str, target_port: str = "443") -> List[IPResult]:
-        """从单个IP源获取特定国家的IP"""
+    def _prefetch_source(self, index: int, target_port: str) -> Optional[asyncio.Task]:
+        """在后台获取第index个IP源的IP列表，没有更多源时返回None"""
+        if index >= len(self.ip_sources):
+            return None
+        return asyncio.create_task(self.get_cf_ips(self.ip_sources[index], target_port))
+
+    async def get_country_ips_from_source(self, ip_source: str, target_port: str = "443",
+                                          ips: Optional[List[str]] = None,
+                                          needed: Optional[int] = None) -> List[IPResult]:
+        """从单个IP源获取特定国家的IP，ips 为已预取的IP列表，needed 为还需要的IP数量"""
         try:
             # 获取IP列表
-            ips = await self.get_cf_ips(ip_source, target_port)
+            if ips is None:
+                ips = await self.get_cf_ips(ip_source, target_port)
             if not ips:
                 return []
 
             print(f"  📥 获取到 {len(ips)} 个IP，开始测试...")
 
             # 测试IP，但是一旦找到足够的目标国家IP就停止
-            results = await self.test_ips_with_early_stop(ips, int(target_port))
+            results = await self.test_ips_with_early_stop(ips, int(target_port), needed)
 
             if not results:
                 return []
@@ -725,16 +996,11 @@ class CloudflareIPOptimizer:
     def save_results_to_file(self, results: List[IPResult], filename: str = "nodes.txt") -> None:
         """保存结果到文件"""
         try:
-            output_path = Path(filename)
-
-            # 生成内容
-            lines = []
-            for result in results:
-                lines.append(result.to_display_format())
-
-            # 写入文件（覆盖模式）
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(lines))
+            # 一次性写入文件（覆盖模式），每行都以换行结尾，便于 wc -l 等工具统计
+            Path(filename).write_text(
+                ''.join(f"{result.to_display_format()}\n" for result in results),
+                encoding='utf-8'
+            )
 
             print(f"成功保存 {len(results)} 个节点到 {filename}")
 
@@ -808,7 +1074,19 @@ async def main():
         sys.exit(1)
     except Exception as e:
         print(f"\n❌ 运行出错: {e}")
+        # 输出完整堆栈，便于排查CI中的失败
+        traceback.print_exc()
         sys.exit(1)
 
+def _run(coro):
+    """运行主协程，安装了uvloop时使用uvloop事件循环"""
+    if uvloop is None:
+        return asyncio.run(coro)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(coro)
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return asyncio.run(coro)
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    _run(main())